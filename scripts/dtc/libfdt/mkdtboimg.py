@@ -18,13 +18,24 @@ from __future__ import print_function
 """Tool for packing multiple DTB/DTBO files into a single image"""
 
 import argparse
+import hashlib
+import mmap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
-from array import array
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import numbers
 import struct
 from sys import stdout
 import zlib
 
+# The zlib-ng bindings are API compatible with zlib and considerably faster,
+# but produce different bytes, so they are only used when asked for.
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+
 class CompressionFormat(object):
     """Enum representing DT compression format for a DT entry.
     """
@@ -41,6 +52,10 @@ class DtEntry(object):
         _COMPRESSION_FORMAT_MASK: Mask to retrieve compression info for DT entry from flags field
             when a DTBO header of version 1 is used.
     """
+    __slots__ = ('__dt_file', '__dt_size', '__dt_offset', '__id', '__rev',
+                 '__flags', '__custom0', '__custom1', '__custom2',
+                 '__compression_format')
+
     _COMPRESSION_FORMAT_MASK = 0x0f
     REQUIRED_KEYS = ('dt_file', 'dt_size', 'dt_offset', 'id', 'rev', 'flags',
                      'custom0', 'custom1', 'custom2')
@@ -50,25 +65,27 @@ class DtEntry(object):
         """Converts string to integer or reads the property from DT image.
 
         Args:
-            arg: String containing the argument provided on the command line.
+            arg: String containing the argument provided on the command line,
+                or an integer already unpacked from a DTBO entry table.
 
         Returns:
             An integer property read from DT file or argument string
             converted to integer
         """
 
+        if isinstance(arg, numbers.Integral):
+            return arg
         if not arg or arg[0] == '+' or arg[0] == '-':
             raise ValueError('Invalid argument passed to DTImage')
         if arg[0] == '/':
             # TODO(b/XXX): Use pylibfdt to get property value from DT
             raise ValueError('Invalid argument passed to DTImage')
-        else:
-            base = 10
-            if arg.startswith('0x') or arg.startswith('0X'):
-                base = 16
-            elif arg.startswith('0'):
-                base = 8
-            return int(arg, base)
+        if arg[:2] in ('0x', '0X'):
+            return int(arg, 16)
+        if arg[0] == '0':
+            # Leading zero means octal, as in C rather than python3
+            return int(arg, 8)
+        return int(arg)
 
     def __init__(self, **kwargs):
         """Constructor for DtEntry object.
@@ -96,6 +113,8 @@ class DtEntry(object):
         self.__custom0 = self.__get_number_or_prop(kwargs['custom0'])
         self.__custom1 = self.__get_number_or_prop(kwargs['custom1'])
         self.__custom2 = self.__get_number_or_prop(kwargs['custom2'])
+        # flags never change after construction, so neither does this
+        self.__compression_format = self.__flags & self._COMPRESSION_FORMAT_MASK
 
     def __str__(self):
         sb = []
@@ -124,9 +143,9 @@ class DtEntry(object):
                 version: Version of DTBO header, compression is only
                          supported from version 1.
         """
-        if version is 0:
+        if version == 0:
             return CompressionFormat.NO_COMPRESSION
-        return self.flags & self._COMPRESSION_FORMAT_MASK
+        return self.__compression_format
 
     @property
     def dt_file(self):
@@ -191,22 +210,37 @@ class Dtbo(object):
         _DTBO_MAGIC: Device tree table header magic.
         _ACPIO_MAGIC: Advanced Configuration and Power Interface table header
                       magic.
+        _DT_TABLE_HEADER_STRUCT: Precompiled struct for Device tree table header.
         _DT_TABLE_HEADER_SIZE: Size of Device tree table header.
         _DT_TABLE_HEADER_INTS: Number of integers in DT table header.
+        _DT_ENTRY_HEADER_STRUCT: Precompiled struct for Device tree entry header.
         _DT_ENTRY_HEADER_SIZE: Size of Device tree entry header within a DTBO.
         _DT_ENTRY_HEADER_INTS: Number of integers in DT entry header.
         _GZIP_COMPRESSION_WBITS: Argument 'wbits' for gzip compression
         _ZLIB_DECOMPRESSION_WBITS: Argument 'wbits' for zlib/gzip compression
+        _DT_FILE_BUFSIZE: Buffer size used when reading or copying DT image
+                          files.
+        _COMPRESSION_LEVEL_ENV: Environment variable overriding the default
+                                zlib/gzip compression level.
+        _ZLIB_NG_ENV: Environment variable that, when set to 1, compresses DT
+                      entries with zlib-ng instead of zlib.
+        _IOV_MAX: Maximum number of buffers passed to a single writev() call.
     """
 
     _DTBO_MAGIC = 0xd7b7ab1e
     _ACPIO_MAGIC = 0x41435049
-    _DT_TABLE_HEADER_SIZE = struct.calcsize('>8I')
+    _DT_TABLE_HEADER_STRUCT = struct.Struct('>8I')
+    _DT_TABLE_HEADER_SIZE = _DT_TABLE_HEADER_STRUCT.size
     _DT_TABLE_HEADER_INTS = 8
-    _DT_ENTRY_HEADER_SIZE = struct.calcsize('>8I')
+    _DT_ENTRY_HEADER_STRUCT = struct.Struct('>8I')
+    _DT_ENTRY_HEADER_SIZE = _DT_ENTRY_HEADER_STRUCT.size
     _DT_ENTRY_HEADER_INTS = 8
     _GZIP_COMPRESSION_WBITS = 31
     _ZLIB_DECOMPRESSION_WBITS = 47
+    _DT_FILE_BUFSIZE = 1 << 20
+    _COMPRESSION_LEVEL_ENV = 'MKDTBOIMG_COMPRESSION_LEVEL'
+    _ZLIB_NG_ENV = 'MKDTBOIMG_USE_ZLIB_NG'
+    _IOV_MAX = 1024
 
     def _update_dt_table_header(self):
         """Converts header entries into binary data for DTBO header.
@@ -214,11 +248,11 @@ class Dtbo(object):
         Packs the current Device tree table header attribute values in
         metadata buffer.
         """
-        struct.pack_into('>8I', self.__metadata, 0, self.magic,
-                         self.total_size, self.header_size,
-                         self.dt_entry_size, self.dt_entry_count,
-                         self.dt_entries_offset, self.page_size,
-                         self.version)
+        self._DT_TABLE_HEADER_STRUCT.pack_into(self.__metadata, 0, self.magic,
+                                               self.total_size, self.header_size,
+                                               self.dt_entry_size, self.dt_entry_count,
+                                               self.dt_entries_offset, self.page_size,
+                                               self.version)
 
     def _update_dt_entry_header(self, dt_entry, metadata_offset):
         """Converts each DT entry header entry into binary data for DTBO file.
@@ -232,10 +266,11 @@ class Dtbo(object):
             dtbo_offset: Offset where the DT image file for this dt_entry can
                 be found in the resulting DTBO image.
         """
-        struct.pack_into('>8I', self.__metadata, metadata_offset, dt_entry.size,
-                         dt_entry.dt_offset, dt_entry.image_id, dt_entry.rev,
-                         dt_entry.flags, dt_entry.custom0, dt_entry.custom1,
-                         dt_entry.custom2)
+        self._DT_ENTRY_HEADER_STRUCT.pack_into(self.__metadata, metadata_offset,
+                                               dt_entry.size, dt_entry.dt_offset,
+                                               dt_entry.image_id, dt_entry.rev,
+                                               dt_entry.flags, dt_entry.custom0,
+                                               dt_entry.custom1, dt_entry.custom2)
 
     def _update_metadata(self):
         """Updates the DTBO metadata.
@@ -244,26 +279,27 @@ class Dtbo(object):
         Tree table entries and update the DTBO header.
         """
 
-        self.__metadata = array('c', ' ' * self.__metadata_size)
+        self.__metadata = bytearray(self.__metadata_size)
+        update_dt_entry_header = self._update_dt_entry_header
+        dt_entry_size = self.dt_entry_size
         metadata_offset = self.header_size
         for dt_entry in self.__dt_entries:
-            self._update_dt_entry_header(dt_entry, metadata_offset)
-            metadata_offset += self.dt_entry_size
+            update_dt_entry_header(dt_entry, metadata_offset)
+            metadata_offset += dt_entry_size
         self._update_dt_table_header()
 
     def _read_dtbo_header(self, buf):
         """Reads DTBO file header into metadata buffer.
 
-        Unpack and read the DTBO table header from given buffer. The
-        buffer size must exactly be equal to _DT_TABLE_HEADER_SIZE.
+        Unpack and read the DTBO table header from the start of given
+        buffer. The buffer size must be at least _DT_TABLE_HEADER_SIZE.
 
         Args:
-            buf: Bytebuffer read directly from the file of size
-                _DT_TABLE_HEADER_SIZE.
+            buf: Bytebuffer read directly from the start of the DTBO file.
         """
         (self.magic, self.total_size, self.header_size,
          self.dt_entry_size, self.dt_entry_count, self.dt_entries_offset,
-         self.page_size, self.version) = struct.unpack_from('>8I', buf, 0)
+         self.page_size, self.version) = self._DT_TABLE_HEADER_STRUCT.unpack_from(buf, 0)
 
         # verify the header
         if self.magic != self._DTBO_MAGIC and self.magic != self._ACPIO_MAGIC:
@@ -281,27 +317,44 @@ class Dtbo(object):
     def _read_dt_entries_from_metadata(self):
         """Reads individual DT entry headers from metadata buffer.
 
-        Unpack and read the DTBO DT entry headers from the internal buffer.
-        The buffer size must exactly be equal to _DT_TABLE_HEADER_SIZE +
-        (_DT_ENTRY_HEADER_SIZE * dt_entry_count). The method raises exception
-        if DT entries have already been set for this object.
+        Unpack and read the DTBO DT entry headers from the raw metadata
+        buffer read from the DTBO file. The buffer must hold dt_entry_count
+        entry headers starting at dt_entries_offset. The method raises
+        exception if DT entries have already been set for this object.
         """
 
         if self.__dt_entries:
             raise ValueError('DTBO DT entries can be added only once')
 
-        offset = self.dt_entries_offset / 4
+        metadata = self.__metadata
+        dt_entry_size = self.dt_entry_size
+        table_start = self.dt_entries_offset
+        table_end = table_start + self.dt_entry_count * dt_entry_size
+        if len(metadata) < table_end:
+            raise ValueError('Invalid or truncated DT entry table in DTBO file')
+
+        # Scan the whole entry table in C where Struct.iter_unpack() is
+        # available (python3.4+), and only build DtEntry objects in python.
+        entry_struct = self._DT_ENTRY_HEADER_STRUCT
+        if hasattr(entry_struct, 'iter_unpack'):
+            # Slicing copies the table out, so no buffer export is left
+            # behind that would keep a mapped metadata buffer from closing.
+            dt_table_entries = entry_struct.iter_unpack(
+                metadata[table_start:table_end])
+        else:
+            dt_table_entries = (entry_struct.unpack_from(metadata, offset)
+                                for offset in range(table_start, table_end,
+                                                    dt_entry_size))
+
+        dt_entries = self.__dt_entries
+        prop_keys = DtEntry.REQUIRED_KEYS[3:]
         params = {}
         params['dt_file'] = None
-        for i in range(0, self.dt_entry_count):
-            dt_table_entry = self.__metadata[offset:offset + self._DT_ENTRY_HEADER_INTS]
+        for dt_table_entry in dt_table_entries:
             params['dt_size'] = dt_table_entry[0]
             params['dt_offset'] = dt_table_entry[1]
-            for j in range(2, self._DT_ENTRY_HEADER_INTS):
-                params[DtEntry.REQUIRED_KEYS[j + 1]] = str(dt_table_entry[j])
-            dt_entry = DtEntry(**params)
-            self.__dt_entries.append(dt_entry)
-            offset += self._DT_ENTRY_HEADER_INTS
+            params.update(zip(prop_keys, dt_table_entry[2:]))
+            dt_entries.append(DtEntry(**params))
 
     def _read_dtbo_image(self):
         """Parse the input file and instantiate this object."""
@@ -312,24 +365,33 @@ class Dtbo(object):
             raise ValueError('Invalid DTBO file')
 
         self.__file.seek(0)
-        buf = self.__file.read(self._DT_TABLE_HEADER_SIZE)
-        self._read_dtbo_header(buf)
+        self._read_dtbo_header(self.__file.read(self._DT_TABLE_HEADER_SIZE))
 
         self.__metadata_size = (self.header_size +
                                 self.dt_entry_count * self.dt_entry_size)
         if file_size < self.__metadata_size:
             raise ValueError('Invalid or truncated DTBO file of size %d expected %d' %
-                             file_size, self.__metadata_size)
-
-        num_ints = (self._DT_TABLE_HEADER_INTS +
-                    self.dt_entry_count * self._DT_ENTRY_HEADER_INTS)
-        if self.dt_entries_offset > self._DT_TABLE_HEADER_SIZE:
-            num_ints += (self.dt_entries_offset - self._DT_TABLE_HEADER_SIZE) / 4
-        format_str = '>' + str(num_ints) + 'I'
-        self.__file.seek(0)
-        self.__metadata = struct.unpack(format_str,
-                                        self.__file.read(self.__metadata_size))
-        self._read_dt_entries_from_metadata()
+                             (file_size, self.__metadata_size))
+
+        # Map just the header and DT entry table rather than copying them
+        # out of the file, falling back to read() for files that cannot be
+        # mapped. The mapping is only needed while the entries are parsed.
+        metadata_end = min(file_size, self.dt_entries_offset +
+                           self.dt_entry_count * self.dt_entry_size)
+        metadata_map = None
+        try:
+            metadata_map = mmap.mmap(self.__file.fileno(), metadata_end,
+                                     access=mmap.ACCESS_READ)
+            self.__metadata = metadata_map
+        except (EnvironmentError, ValueError):
+            self.__file.seek(0)
+            self.__metadata = self.__file.read(metadata_end)
+        try:
+            self._read_dt_entries_from_metadata()
+        finally:
+            if metadata_map is not None:
+                metadata_map.close()
+            self.__metadata = None
 
     def _find_dt_entry_with_same_file(self, dt_entry):
         """Finds DT Entry that has identical backing DT file.
@@ -342,27 +404,104 @@ class Dtbo(object):
             from internal list is returned. If not, 'None' is returned.
         """
 
-        dt_entry_path = os.path.realpath(dt_entry.dt_file.name)
-        for entry in self.__dt_entries:
-            entry_path = os.path.realpath(entry.dt_file.name)
-            if entry_path == dt_entry_path:
-                return entry
-        return None
+        return self.__dt_entry_paths.get(os.path.realpath(dt_entry.dt_file.name))
+
+    def _dt_file_digest(self, dt_file):
+        """Computes the SHA-256 digest of a DT image file's contents.
 
-    def __init__(self, file_handle, dt_type='dtb', page_size=None, version=0):
+        Args:
+            dt_file: File handle to the DT image file.
+
+        Returns:
+            The digest as a byte string.
+        """
+        digest = hashlib.sha256()
+        dt_file.seek(0)
+        while True:
+            chunk = dt_file.read(self._DT_FILE_BUFSIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+        return digest.digest()
+
+    def _get_compression_level(self, compression_level):
+        """Resolves the zlib level used to compress DT entries.
+
+        Args:
+            compression_level: Requested level, or None to use the value of
+                _COMPRESSION_LEVEL_ENV or zlib.Z_DEFAULT_COMPRESSION.
+
+        Returns:
+            The compression level as an integer from -1 to 9.
+
+        Raises:
+            ValueError: if the requested level is not an integer from -1 to 9.
+        """
+        if compression_level is None:
+            env_level = os.environ.get(self._COMPRESSION_LEVEL_ENV)
+            if env_level is None:
+                return zlib.Z_DEFAULT_COMPRESSION
+            try:
+                compression_level = int(env_level)
+            except ValueError:
+                raise ValueError('Invalid compression level %r in %s, expected -1 to 9' %
+                                 (env_level, self._COMPRESSION_LEVEL_ENV))
+
+        if (not isinstance(compression_level, numbers.Integral) or
+                not -1 <= compression_level <= 9):
+            raise ValueError('Invalid compression level %r, expected -1 to 9' %
+                             (compression_level,))
+        return compression_level
+
+    def _get_deflate_module(self, use_zlib_ng):
+        """Returns the module used to compress DT entries.
+
+        Args:
+            use_zlib_ng: Whether to use zlib-ng, or None to use it only if
+                _ZLIB_NG_ENV is set to 1.
+
+        Returns:
+            The zlib_ng module if requested, the stdlib zlib module otherwise.
+
+        Raises:
+            ValueError: if zlib-ng is requested but not installed.
+        """
+        if use_zlib_ng is None:
+            use_zlib_ng = os.environ.get(self._ZLIB_NG_ENV) == '1'
+        if not use_zlib_ng:
+            return zlib
+        if zlib_ng is None:
+            raise ValueError('zlib-ng compression requested but the zlib_ng '
+                             'module is not installed')
+        return zlib_ng
+
+    def __init__(self, file_handle, dt_type='dtb', page_size=None, version=0,
+                 compression_level=None, use_zlib_ng=None):
         """Constructor for Dtbo Object
 
         Args:
             file_handle: The Dtbo File handle corresponding to this object.
                 The file handle can be used to write to (in case of 'create')
                 or read from (in case of 'dump')
+            compression_level: zlib level (-1 to 9) used to compress DT
+                entries when creating a DTBO. Defaults to the value of
+                _COMPRESSION_LEVEL_ENV if set, or zlib.Z_DEFAULT_COMPRESSION
+                otherwise.
+            use_zlib_ng: Compress DT entries with zlib-ng rather than zlib
+                when creating a DTBO. Defaults to whether _ZLIB_NG_ENV is
+                set to 1.
         """
 
         self.__file = file_handle
         self.__dt_entries = []
+        self.__dt_entry_paths = {}
+        self.__dt_entry_digests = {}
         self.__metadata = None
         self.__metadata_size = 0
 
+        self.__compression_level = zlib.Z_DEFAULT_COMPRESSION
+        self.__deflate = zlib
+
         # if page_size is given, assume the object is being instantiated to
         # create a DTBO file
         if page_size:
@@ -378,6 +517,8 @@ class Dtbo(object):
             self.page_size = page_size
             self.version = version
             self.__metadata_size = self._DT_TABLE_HEADER_SIZE
+            self.__compression_level = self._get_compression_level(compression_level)
+            self.__deflate = self._get_deflate_module(use_zlib_ng)
         else:
             self._read_dtbo_image()
 
@@ -418,28 +559,152 @@ class Dtbo(object):
         Raises:
             ValueError if unrecognized compression format is found.
         """
-        compress_zlib = zlib.compressobj()  #  zlib
-        compress_gzip = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
-                                         zlib.DEFLATED, self._GZIP_COMPRESSION_WBITS)  #  gzip
-        compression_obj_dict = {
-            CompressionFormat.NO_COMPRESSION: None,
-            CompressionFormat.ZLIB_COMPRESSION: compress_zlib,
-            CompressionFormat.GZIP_COMPRESSION: compress_gzip,
-        }
-
-        if compression_format not in compression_obj_dict:
-            ValueError("Bad compression format %d" % compression_format)
-
-        if compression_format is CompressionFormat.NO_COMPRESSION:
+        if compression_format == CompressionFormat.NO_COMPRESSION:
+            dt_entry_file.seek(0)
             dt_entry = dt_entry_file.read()
+            return dt_entry, len(dt_entry)
+
+        if compression_format == CompressionFormat.ZLIB_COMPRESSION:
+            compression_object = self.__deflate.compressobj(self.__compression_level)
+        elif compression_format == CompressionFormat.GZIP_COMPRESSION:
+            compression_object = self.__deflate.compressobj(self.__compression_level,
+                                                            zlib.DEFLATED,
+                                                            self._GZIP_COMPRESSION_WBITS)
         else:
-            compression_object = compression_obj_dict[compression_format]
-            dt_entry_file.seek(0)
-            dt_entry = compression_object.compress(dt_entry_file.read())
-            dt_entry += compression_object.flush()
+            raise ValueError("Bad compression format %d" % compression_format)
+
+        # Feed the compressor in chunks so the whole DT image file never
+        # has to be held in memory next to its compressed copy.
+        dt_entry_file.seek(0)
+        dt_entry_chunks = []
+        while True:
+            chunk = dt_entry_file.read(self._DT_FILE_BUFSIZE)
+            if not chunk:
+                break
+            dt_entry_chunks.append(compression_object.compress(chunk))
+        dt_entry_chunks.append(compression_object.flush())
+        dt_entry = b''.join(dt_entry_chunks)
         return dt_entry, len(dt_entry)
 
-    def add_dt_entries(self, dt_entries):
+    @staticmethod
+    def _write_fd(fd, buf):
+        """Writes a whole buffer to a file descriptor.
+
+        Args:
+            fd: File descriptor to write to at its current offset.
+            buf: Buffer to be written.
+        """
+        view = memoryview(buf)
+        while len(view):
+            view = view[os.write(fd, view):]
+
+    def _writev_fd(self, fd, bufs):
+        """Writes a list of buffers to a file descriptor back to back.
+
+        Gathers the buffers into as few os.writev() calls as possible where
+        it is available, otherwise writes them one at a time.
+
+        Args:
+            fd: File descriptor to write to at its current offset.
+            bufs: List of buffers to be written.
+        """
+        if not hasattr(os, 'writev'):
+            for buf in bufs:
+                self._write_fd(fd, buf)
+            return
+
+        for i in range(0, len(bufs), self._IOV_MAX):
+            group = bufs[i:i + self._IOV_MAX]
+            written = os.writev(fd, group)
+            # Finish off whatever a short writev() left behind
+            for buf in group:
+                if written >= len(buf):
+                    written -= len(buf)
+                else:
+                    self._write_fd(fd, memoryview(buf)[written:])
+                    written = 0
+
+    def copy_dt_entry(self, dt_entry_file, out_fd):
+        """Copies an uncompressed DT entry into a file.
+
+        Uses os.sendfile() where available so the DT image is copied by
+        the kernel, otherwise falls back to a buffered copy.
+
+        Args:
+            dt_entry_file: File handle to read DT entry from.
+            out_fd: File descriptor positioned where the DT entry is to be
+                written.
+
+        Returns:
+            Length of the copied DT entry.
+        """
+        size = os.fstat(dt_entry_file.fileno()).st_size
+        if hasattr(os, 'sendfile'):
+            in_fd = dt_entry_file.fileno()
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if not sent:
+                    raise ValueError('Unexpected end of DT image file %s' %
+                                     dt_entry_file.name)
+                offset += sent
+        else:
+            dt_entry_file.seek(0)
+            while True:
+                chunk = dt_entry_file.read(self._DT_FILE_BUFSIZE)
+                if not chunk:
+                    break
+                self._write_fd(out_fd, chunk)
+        return size
+
+    def _compress_dt_entries(self, dt_entries):
+        """Compresses the DT image files of a list of DT entries.
+
+        zlib releases the GIL while deflating, so DT image files are
+        compressed on a pool of threads. DT entries sharing a file handle
+        are compressed one after another by the same thread, since every
+        compression seeks and reads through that handle.
+
+        Args:
+            dt_entries: List of DtEntry objects whose DT image file is to be
+                compressed according to its compression info.
+
+        Returns:
+            A list of compressed DT entries in the order of 'dt_entries'.
+        """
+        def compress(dt_entry):
+            return self.compress_dt_entry(dt_entry.compression_info(self.version),
+                                          dt_entry.dt_file)[0]
+
+        def compress_group(group):
+            return [compress(dt_entry) for dt_entry in group]
+
+        groups = OrderedDict()
+        for dt_entry in dt_entries:
+            groups.setdefault(id(dt_entry.dt_file), []).append(dt_entry)
+        groups = list(groups.values())
+
+        try:
+            workers = min(cpu_count(), len(groups))
+        except NotImplementedError:
+            workers = 1
+
+        if workers < 2:
+            return compress_group(dt_entries)
+
+        pool = ThreadPool(workers)
+        try:
+            group_results = pool.map(compress_group, groups)
+        finally:
+            pool.close()
+            pool.join()
+
+        compressed_entries = {}
+        for group, results in zip(groups, group_results):
+            compressed_entries.update(zip(group, results))
+        return [compressed_entries[dt_entry] for dt_entry in dt_entries]
+
+    def add_dt_entries(self, dt_entries, fout=None):
         """Adds DT image files to the DTBO object.
 
         Adds a list of Dtentry Objects to the DTBO image. The changes are not
@@ -447,9 +712,14 @@ class Dtbo(object):
 
         Args:
             dt_entries: List of DtEntry object to be added.
+            fout: Optional file handle or descriptor of the DTBO file. If
+                given, DT image files are written directly into it at their
+                offsets with unbuffered writes instead of being buffered, and
+                uncompressed ones are not read into memory at all.
 
         Returns:
-            A buffer containing all DT entries.
+            A buffer containing all DT entries, or an empty buffer if 'fout'
+            is given.
 
         Raises:
             ValueError: if the list of DT entries is empty or if a list of DT entries
@@ -465,29 +735,71 @@ class Dtbo(object):
         dt_offset = (self.header_size +
                      dt_entry_count * self.dt_entry_size)
 
-        dt_entry_buf = ""
+        # Match up DT entries sharing a DT image file, by path or else by
+        # contents, first so that every remaining DT image file can be
+        # compressed independently.
+        same_file_entries = []
+        new_dt_entries = []
         for dt_entry in dt_entries:
             if not isinstance(dt_entry, DtEntry):
                 raise ValueError('Adding invalid DT entry object to DTBO')
             entry = self._find_dt_entry_with_same_file(dt_entry)
             dt_entry_compression_info = dt_entry.compression_info(self.version)
-            if entry and (entry.compression_info(self.version)
-                          == dt_entry_compression_info):
-                dt_entry.dt_offset = entry.dt_offset
-                dt_entry.size = entry.size
-            else:
-                dt_entry.dt_offset = dt_offset
-                compressed_entry, dt_entry.size = self.compress_dt_entry(dt_entry_compression_info,
-                                                                         dt_entry.dt_file)
-                dt_entry_buf += compressed_entry
-                dt_offset += dt_entry.size
-                self.total_size += dt_entry.size
+            if not entry or (entry.compression_info(self.version)
+                             != dt_entry_compression_info):
+                digest_key = (self._dt_file_digest(dt_entry.dt_file),
+                              dt_entry_compression_info)
+                entry = self.__dt_entry_digests.get(digest_key)
+                if not entry:
+                    self.__dt_entry_digests[digest_key] = dt_entry
+                    if (fout is None or dt_entry_compression_info !=
+                            CompressionFormat.NO_COMPRESSION):
+                        new_dt_entries.append(dt_entry)
+            same_file_entries.append(entry)
             self.__dt_entries.append(dt_entry)
+            self.__dt_entry_paths.setdefault(os.path.realpath(dt_entry.dt_file.name),
+                                             dt_entry)
             self.dt_entry_count += 1
             self.__metadata_size += self.dt_entry_size
             self.total_size += self.dt_entry_size
 
-        return dt_entry_buf
+        compressed_entries = dict(zip(new_dt_entries,
+                                      self._compress_dt_entries(new_dt_entries)))
+
+        out_fd = None
+        if fout is not None:
+            if isinstance(fout, numbers.Integral):
+                out_fd = fout
+            else:
+                fout.flush()
+                out_fd = fout.fileno()
+            # DT image files are laid out back to back, so one seek to the
+            # first one is enough.
+            os.lseek(out_fd, dt_offset, os.SEEK_SET)
+
+        dt_entry_bufs = []
+        for dt_entry, entry in zip(dt_entries, same_file_entries):
+            if entry:
+                dt_entry.dt_offset = entry.dt_offset
+                dt_entry.size = entry.size
+                continue
+            dt_entry.dt_offset = dt_offset
+            if dt_entry in compressed_entries:
+                compressed_entry = compressed_entries[dt_entry]
+                dt_entry.size = len(compressed_entry)
+                dt_entry_bufs.append(compressed_entry)
+            else:
+                # Flush the payloads gathered so far to keep the file order
+                self._writev_fd(out_fd, dt_entry_bufs)
+                dt_entry_bufs = []
+                dt_entry.size = self.copy_dt_entry(dt_entry.dt_file, out_fd)
+            dt_offset += dt_entry.size
+            self.total_size += dt_entry.size
+
+        if out_fd is not None:
+            self._writev_fd(out_fd, dt_entry_bufs)
+            return b''
+        return b''.join(dt_entry_bufs)
 
     def extract_dt_file(self, idx, fout, decompress):
         """Extract DT Image files embedded in the DTBO file.